@@ -12,25 +12,55 @@ Features:
   - GIT_BRANCH: Branch to track for changes (default: main).
   - POLL_INTERVAL: Time interval (in seconds) between checks (default: 60).
   - ROLLOUT_NAMESPACE: Kubernetes namespace where the deployments reside.
+  - WEBHOOK_SECRET: Shared secret enabling the push webhook listener.
+  - WEBHOOK_PORT: Port of the push webhook listener (default: 8080).
+  - WEBHOOK_FALLBACK_INTERVAL: Poll interval (in seconds) used while the
+    webhook listener is enabled (default: 3600).
 - Uses Kubernetes API to apply rolling updates when changes are detected.
 
 """
 
 import time
-import subprocess
 import os
 import logging
+import hmac
+import hashlib
+import json
+import threading
+import functools
+import signal
+import shlex
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit, urlunsplit
 import git
+import requests
 import yaml
+from dulwich.client import SSHGitClient, get_transport_and_path
+from dulwich.diff_tree import tree_changes
+from dulwich.object_store import DiskObjectStore
 from kubernetes import client, config
 
+# libyaml bindings are much faster than the pure Python loader, when available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# Deployments patched in parallel, each patch is one round-trip to the API server
+ROLLOUT_WORKERS = 8
+_rollout_executor = ThreadPoolExecutor(max_workers=ROLLOUT_WORKERS)
+
+# All Kubernetes calls go through this single client and its connection pool,
+# sized above ROLLOUT_WORKERS. Never instantiate client.AppsV1Api() without
+# it: every new ApiClient opens its own pool and pays a new TLS handshake.
 config.load_incluster_config()
-v1_apps = client.AppsV1Api()
+api_configuration = client.Configuration.get_default_copy()
+api_configuration.connection_pool_maxsize = 16
+v1_apps = client.AppsV1Api(client.ApiClient(api_configuration))
 
 GIT_REPO_URL = os.getenv('GIT_REPO_URL', '')
 GIT_BRANCH = os.getenv('GIT_BRANCH', 'main')
@@ -40,36 +70,153 @@ ROLLOUT_MAPPING_FILE = os.getenv('ROLLOUT_MAPPING_FILE', '/tmp/datadirsync/rollo
 GIT_USERNAME = os.getenv('GIT_USERNAME', '')
 GIT_TOKEN = os.getenv('GIT_TOKEN', '')
 GIT_SSH_COMMAND = os.getenv('GIT_SSH_COMMAND', '')
+SSH_CONTROL_PATH = '/tmp/datadirsync-ssh-%C'
+SSH_CONTROL_PERSIST = max(600, 2 * POLL_INTERVAL)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_FALLBACK_INTERVAL = int(os.getenv('WEBHOOK_FALLBACK_INTERVAL', '3600'))
+# GitHub caps push payloads at 25 MB
+WEBHOOK_MAX_BODY_SIZE = 25 * 1024 * 1024
 
+# Serializes commit processing between the poll loop and webhook handlers.
+_rollout_lock = threading.Lock()
+_latest_commit = None
+_latest_tree = None
+# Last deployment map parsed successfully, used while the mapping file is invalid
+_deployment_map = None
 
-def checkout_repo(repo, branch):
-    default_branch = repo.git.rev_parse('--abbrev-ref', 'HEAD')
-    remote_branches = [ref.name for ref in repo.remote().refs]
-    remote_branch = f'origin/{branch}'
+# Set to interrupt the wait between two polls, on shutdown or webhook request
+_wakeup = threading.Event()
+_shutdown = threading.Event()
 
-    if branch == default_branch:
-        logging.info(f"Branch {branch} is the default branch, already checked out.")
-    elif remote_branch in remote_branches:
-        logging.info(f"Branch {branch} existing in refs.")
-        repo.git.checkout('-b', branch, remote_branch)
-        logging.info(f"Checkout of branch {branch} done.")
-    else:
-        logging.warning(f"Branch {branch} not found in remote. Using default branch.")
+# Latest commit per (git_url, git_branch), as {key: (expiry, sha)}
+COMMIT_CACHE_TTL = POLL_INTERVAL // 2
+_commit_cache = {}
+
+# Git clients per repository URL, kept to reuse connections across polls
+_client_cache = {}
+
+# Commits API pollers per (git_url, git_branch), None when the host is unsupported
+_poller_cache = {}
+
+# Object stores of local clones opened with dulwich, kept to reuse the pack index
+_object_store_cache = {}
+
+# Affected deployments per (commit_range, id(deployment_map)), least recently used first
+AFFECTED_CACHE_SIZE = 256
+_affected_cache = OrderedDict()
 
 
 def clone_repo(repo_url, branch, clone_path):
+    """Bare clone the tracked branch without history nor file contents.
+
+    Only trees are needed to list the files changed by a commit, blobs are
+    never fetched and no working tree is ever written.
+    """
     if not os.path.exists(clone_path):
         logging.info("Cloning repository ...")
         os.makedirs(clone_path, exist_ok=True)
-        repo = git.Repo.clone_from(repo_url, clone_path)
-        logging.info("Repository cloned.")
-        checkout_repo(repo, branch)
-        logging.info(f"Repository cloned and switched to branch {branch}")
+        git.Repo.clone_from(repo_url, clone_path, multi_options=[
+            '--filter=blob:none', '--depth=1', '--single-branch', f'--branch={branch}', '--bare'
+        ])
+        logging.info("Repository cloned on branch %s", branch)
+
+class PathTrie:
+    """Deployment map indexed by path segments.
+
+    Every node is a (children, deployments) pair. The deployments of the root
+    node are the ones mapped to the '*' wildcard.
+    """
+
+    def __init__(self, deployment_map):
+        if not isinstance(deployment_map, dict):
+            raise ValueError("The deployment map must be a mapping")
+        self.root = ({}, set())
+        for key, deployments in deployment_map.items():
+            node = self.root
+            if key != '*':
+                # Unquoted YAML keys such as 2024 are not parsed as strings
+                for segment in str(key).strip('/').split('/'):
+                    node = node[0].setdefault(segment, ({}, set()))
+            if deployments is not None and not isinstance(deployments, list):
+                raise ValueError(f"Deployments of {key} must be a list")
+            node[1].update(deployment.strip() for deployment in deployments or ())
+
+    @property
+    def wildcard(self):
+        return self.root[1]
+
+    def all_deployments(self):
+        """Return every deployment of the map, whatever its key."""
+        deployments = set()
+        nodes = [self.root]
+        while nodes:
+            children, node_deployments = nodes.pop()
+            deployments.update(node_deployments)
+            nodes.extend(children.values())
+        return frozenset(deployments)
 
 def load_deployment_map(file_path):
-    """Load the mapping of folders and files to deployments from a YAML file."""
+    """Load the mapping of folders and files to deployments from a YAML file.
+
+    The parsed map is cached until the file modification time changes, so an
+    updated ConfigMap is picked up without re-parsing it on every commit.
+    """
+    return read_deployment_map(file_path, os.stat(file_path).st_mtime_ns)
+
+def current_deployment_map():
+    """Reload the deployment map, keeping the last valid one if it is broken.
+
+    Only raises if no valid map was ever loaded.
+    """
+    global _deployment_map
+    try:
+        _deployment_map = load_deployment_map(ROLLOUT_MAPPING_FILE)
+    except Exception as e:
+        if _deployment_map is None:
+            raise
+        logging.error("Invalid deployment map %s, using the last valid one: %s", ROLLOUT_MAPPING_FILE, e)
+    return _deployment_map
+
+@functools.lru_cache(maxsize=4)
+def read_deployment_map(file_path, mtime_ns):
+    """Parse the deployment map, cached per file path and modification time."""
     with open(file_path, 'r') as file:
-        return yaml.safe_load(file)
+        return PathTrie(yaml.load(file, Loader=YamlLoader) or {})
+
+def show_ssh_key(git_ssh_command):
+    """Log the private key file passed with -i to the SSH command, if any."""
+    try:
+        tokens = shlex.split(git_ssh_command)
+        ssh_key_path = tokens[tokens.index('-i') + 1]
+    except (ValueError, IndexError):
+        logging.info("No SSH key file (-i) set in the SSH command.")
+        return
+
+    if os.path.isfile(ssh_key_path):
+        logging.info("SSH key file: %s", ssh_key_path)
+    else:
+        logging.warning("SSH key file %s not found.", ssh_key_path)
+
+def enable_ssh_multiplexing(git_ssh_command):
+    """Add OpenSSH connection sharing options to the SSH command.
+
+    Ref listings and fetches then reuse one master connection, kept open for
+    SSH_CONTROL_PERSIST seconds, instead of each paying a new SSH handshake.
+    The options are inserted after the program name, the rest of the command
+    is kept verbatim since git runs it through a shell. Commands starting with
+    variable assignments (GIT_TRACE=1 ssh ...) are left untouched.
+    """
+    if not git_ssh_command.strip() or 'ControlMaster' in git_ssh_command:
+        # Nothing to extend, or already configured by the user
+        return git_ssh_command
+    program, *arguments = git_ssh_command.split(None, 1)
+    if '=' in program:
+        logging.info("SSH command starts with a variable assignment, not enabling multiplexing.")
+        return git_ssh_command
+    options = (f'-o ControlMaster=auto -o ControlPath={SSH_CONTROL_PATH} '
+               f'-o ControlPersist={SSH_CONTROL_PERSIST}')
+    return ' '.join([program, options, *arguments])
 
 def determine_repo_url(git_url, git_username, git_token, git_ssh_command):
     """Determine the git URL based on the authentication method."""
@@ -84,87 +231,464 @@ def determine_repo_url(git_url, git_username, git_token, git_ssh_command):
         logging.info("Using anonymous git access")
     return git_url
 
+def get_git_client(git_url, git_ssh_command=None):
+    """Return the cached in-process Git client and remote path for a URL.
+
+    HTTP credentials are handed to the client separately so that they never
+    appear in the URLs quoted by its error messages.
+    """
+    if git_url not in _client_cache:
+        client_url = git_url
+        credentials = {}
+        parsed = urlsplit(git_url)
+        if parsed.scheme in ('http', 'https') and (parsed.username or parsed.password):
+            credentials = {'username': unquote(parsed.username or ''), 'password': unquote(parsed.password or '')}
+            client_url = urlunsplit(parsed._replace(netloc=parsed.netloc.rpartition('@')[2]))
+        client, path = get_transport_and_path(client_url, **credentials)
+        if git_ssh_command and isinstance(client, SSHGitClient):
+            # dulwich splits the command without a shell: run it through one,
+            # as git does, so that variables like $HOME are still expanded
+            client.ssh_command = shlex.join(['sh', '-c', f'{git_ssh_command} "$@"', 'ssh'])
+        _client_cache[git_url] = (client, path)
+    return _client_cache[git_url]
+
+class CommitPoller:
+    """Poll the head commit of a branch through a hosting provider's REST API.
+
+    The ETag of the last response is sent back with every request, so an
+    unchanged branch only costs an empty 304 Not Modified response.
+    """
+
+    def __init__(self, api_url, headers, parse_commit):
+        self.api_url = api_url
+        self.parse_commit = parse_commit
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.etag = None
+        self.commit = None
+
+    def get_latest_commit(self):
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        response = self.session.get(self.api_url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            return self.commit
+        response.raise_for_status()
+        self.commit = self.parse_commit(response)
+        self.etag = response.headers.get('ETag')
+        return self.commit
+
+def create_commit_poller(git_url, git_branch):
+    """Build a CommitPoller for HTTPS GitHub and GitLab URLs, None otherwise.
+
+    Anonymous GitHub API calls are limited to 60 per hour and per IP, shared
+    by every client behind the same NAT: GitHub is only polled through its
+    API when a token is set.
+    """
+    parsed = urlsplit(git_url)
+    if parsed.scheme != 'https':
+        return None
+    repo_path = parsed.path.strip('/').removesuffix('.git')
+    token = parsed.password
+
+    if parsed.hostname == 'github.com' and token:
+        return CommitPoller(
+            f"https://api.github.com/repos/{repo_path}/commits/{quote(git_branch)}",
+            {'Accept': 'application/vnd.github.sha', 'Authorization': f'Bearer {token}'},
+            lambda response: response.text.strip()
+        )
+    if parsed.hostname == 'gitlab.com':
+        headers = {'PRIVATE-TOKEN': token} if token else {}
+        return CommitPoller(
+            f"https://gitlab.com/api/v4/projects/{quote(repo_path, safe='')}"
+            f"/repository/branches/{quote(git_branch, safe='')}",
+            headers,
+            lambda response: response.json()['commit']['id']
+        )
+    return None
+
+def get_commit_poller(git_url, git_branch):
+    """Return the cached CommitPoller for a branch, if its host is supported."""
+    key = (git_url, git_branch)
+    if key not in _poller_cache:
+        _poller_cache[key] = create_commit_poller(git_url, git_branch)
+    return _poller_cache[key]
+
 def get_latest_commit(git_url, git_branch, git_ssh_command=None):
-    """Retrieve the latest commit hash from the specified Git branch."""
-
-    result = subprocess.run(
-        ["git", "ls-remote", git_url, f"refs/heads/{git_branch}"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        env={**os.environ, 'GIT_SSH_COMMAND': git_ssh_command} if git_ssh_command else None
-    )
+    """Retrieve the latest commit hash from the specified Git branch.
+
+    GitHub (with a token) and GitLab repositories are polled through their
+    REST API, other remotes through the Git protocol. Results are cached for
+    COMMIT_CACHE_TTL seconds to coalesce repeated lookups.
+    """
+    key = (git_url, git_branch)
+    cached = _commit_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+
+    commit = None
+    poller = get_commit_poller(git_url, git_branch)
+    if poller is not None:
+        try:
+            commit = poller.get_latest_commit()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning("Commits API request failed, falling back to git: %s", e)
+            if isinstance(e, requests.HTTPError) and e.response.status_code in (401, 404):
+                # Repository not reachable through the API, stop using it for this branch.
+                # Server errors and rate limits only fall back to git for this poll.
+                _poller_cache[key] = None
+
+    if commit is None:
+        commit = get_remote_commit(git_url, git_branch, git_ssh_command)
+
+    _commit_cache[key] = (time.monotonic() + COMMIT_CACHE_TTL, commit)
+    return commit
+
+def get_remote_commit(git_url, git_branch, git_ssh_command=None):
+    """Retrieve the head commit of a branch through the Git protocol."""
+    client, path = get_git_client(git_url, git_ssh_command)
+    ref = f"refs/heads/{git_branch}".encode()
+    try:
+        refs = client.get_refs(path)
+    except Exception as e:
+        logging.error("Git ls-remote failed: %s", e)
+        raise Exception("Failed to get latest commit")
 
-    if result.returncode != 0:
-        logging.error(f"Git command failed: {result.stderr}")
+    if ref not in refs:
+        logging.error("Branch %s not found in remote", git_branch)
         raise Exception("Failed to get latest commit")
 
-    return result.stdout.split()[0]
+    return refs[ref].decode()
 
-def get_changed_files(repo_path, branch, commit_hash, git_ssh_command=None):
-    repo = git.Repo(repo_path)
-    repo.git.fetch()
-    repo.git.checkout(commit_hash)
-    """Obtain the list of files changed in the specified commit."""
-    result = subprocess.run(
-        ["git", "show", "--name-only", commit_hash],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        cwd=repo_path,
-        env={**os.environ, 'GIT_SSH_COMMAND': git_ssh_command} if git_ssh_command else None
-    )
+def invalidate_commit_cache():
+    """Forget cached commits so the next lookup hits the remote."""
+    _commit_cache.clear()
 
-    if result.returncode != 0:
-        logging.error(f"Git command failed: {result.stderr}")
-        raise Exception("Failed to get changed files")
+def get_object_store(repo_path):
+    """Return the cached dulwich object store of the local bare clone.
+
+    The object store is opened directly as dulwich refuses to open partial
+    clones as repositories.
+    """
+    if repo_path not in _object_store_cache:
+        _object_store_cache[repo_path] = DiskObjectStore(os.path.join(repo_path, 'objects'))
+    return _object_store_cache[repo_path]
 
-    files_changed = result.stdout.splitlines()[6:]
+def fetch_commit(repo_path, commit_hash, git_ssh_command=None):
+    """Fetch a commit and its tree, without history, into the local clone."""
+    repo = git.Repo(repo_path)
+    if git_ssh_command:
+        repo.git.update_environment(GIT_SSH_COMMAND=git_ssh_command)
+    repo.git.fetch('origin', commit_hash, depth=1)
 
-    return files_changed
+def get_commit_tree(repo_path, commit_hash):
+    """Return the tree hash of a commit, or None if it is not in the local clone."""
+    object_store = get_object_store(repo_path)
+    try:
+        return object_store[commit_hash.encode()].tree.decode()
+    except KeyError:
+        return None
 
-def determine_affected_deployments(changed_files, artifact_to_deployment_map):
-    """Determine which deployments should be rolled based on changed files."""
-    affected_deployments = set()
+def get_changed_files(repo_path, old_tree, new_tree):
+    """Obtain the list of files changed between two trees of the local clone."""
+    object_store = get_object_store(repo_path)
+    try:
+        changes = tree_changes(object_store, old_tree.encode(), new_tree.encode())
+        return [(change.new.path or change.old.path).decode() for change in changes]
+    except KeyError as e:
+        logging.error("Git object not found: %s", e)
+        raise Exception("Failed to get changed files")
 
-    if '*' in artifact_to_deployment_map:
+def get_changes_since(repo_path, previous_commit, previous_tree, tree_sha, git_ssh_command=None):
+    """List the files changed from the last processed commit to a tree.
+
+    Diffing the trees covers every commit in between, whatever the number of
+    pushes or polls they came in. The previous tree is fetched when missing
+    from the local clone. Returns None when there is no previous commit or it
+    cannot be fetched anymore, e.g. after a force push.
+    """
+    if previous_commit is None:
+        return None
+    if previous_tree is None or previous_tree.encode() not in get_object_store(repo_path):
+        try:
+            fetch_commit(repo_path, previous_commit, git_ssh_command)
+        except git.GitCommandError as e:
+            logging.warning("Failed to fetch previous commit %s: %s", previous_commit, e)
+            return None
+        previous_tree = get_commit_tree(repo_path, previous_commit)
+        if previous_tree is None:
+            return None
+    return get_changed_files(repo_path, previous_tree, tree_sha)
+
+def determine_affected_deployments(changed_files, deployment_trie):
+    """Determine which deployments should be rolled based on changed files.
+
+    A file triggers the deployments mapped to itself and to any of its parent
+    folders.
+    """
+    affected_deployments = set(deployment_trie.wildcard)
+    if affected_deployments:
         # If '*' is a key in the map, all changes trigger these deployments
         logging.info("Wildcard '*' detected in deployment map; all changes will trigger associated deployments.")
-        affected_deployments.update(artifact_to_deployment_map['*'])
 
+    root_children = deployment_trie.root[0]
     for changed_file in changed_files:
-        # Check if the file itself is mapped
-        if changed_file in artifact_to_deployment_map:
-            affected_deployments.update(artifact_to_deployment_map[changed_file])
-
-        # Check if the folder is mapped
-        folder = changed_file.split('/')[0]
-        if folder in artifact_to_deployment_map:
-            affected_deployments.update(artifact_to_deployment_map[folder])
-
-    return list(affected_deployments)
+        children = root_children
+        remaining_path = changed_file
+        # Consume one segment at a time, most paths stop matching at the first one
+        while remaining_path:
+            segment, _, remaining_path = remaining_path.partition('/')
+            node = children.get(segment)
+            if node is None:
+                break
+            children, deployments = node
+            if deployments:
+                affected_deployments.update(deployments)
+
+    return frozenset(affected_deployments)
+
+def affected_deployments_for_commit(commit_range, changed_files, deployment_trie):
+    """Memoize determine_affected_deployments per commit range and deployment map.
+
+    commit_range is the (previous_commit, commit_sha) pair changed_files was
+    computed from.
+    """
+    key = (commit_range, id(deployment_trie))
+    if key in _affected_cache:
+        _affected_cache.move_to_end(key)
+        return _affected_cache[key][1]
+
+    affected_deployments = determine_affected_deployments(changed_files, deployment_trie)
+    # Keep a reference on the map so its id cannot be reused while cached
+    _affected_cache[key] = (deployment_trie, affected_deployments)
+    if len(_affected_cache) > AFFECTED_CACHE_SIZE:
+        _affected_cache.popitem(last=False)
+    return affected_deployments
+
+def patch_deployment(deployment_name, namespace, patch):
+    """Apply the rollout patch to a deployment, restarting its pods."""
+    logging.info("Triggering rollout for %s in %s...", deployment_name, namespace)
+    # The patched Deployment sent back is not used: skip its deserialization
+    # into client models and only drain the raw response back into the pool.
+    response = v1_apps.patch_namespaced_deployment(
+        name=deployment_name, namespace=namespace, body=patch, _preload_content=False
+    )
+    response.read()
+    response.release_conn()
 
 def trigger_rollout(deployment_names, namespace):
-    """Trigger a Kubernetes rollout for the specified deployments."""
-    deployment_name_list = deployment_names.split(',')
-
-    for deployment_name in deployment_name_list:
-        deployment_name = deployment_name.strip()
-        logging.info(f"Triggering rollout for {deployment_name} in {namespace}...")
-        patch = {"spec": {"template": {"metadata": {"annotations": {"rollout-time": str(time.time())}}}}}
-        v1_apps.patch_namespaced_deployment(name=deployment_name, namespace=namespace, body=patch)
+    """Trigger a Kubernetes rollout for the specified deployments.
+
+    deployment_names is an iterable of already stripped names. Deployments are
+    patched concurrently with the same rollout-time; the first failure is
+    re-raised once all patches are done.
+    """
+    rollout_time = str(time.time_ns())
+    patch = {"spec": {"template": {"metadata": {"annotations": {"rollout-time": rollout_time}}}}}
+    futures = [_rollout_executor.submit(patch_deployment, deployment_name, namespace, patch)
+               for deployment_name in deployment_names]
+    wait(futures)
+    for future in futures:
+        future.result()
+
+def on_push(commit_sha, changed_files, tree_sha=None, previous_commit=None):
+    """Roll out the deployments affected by a new commit, once per commit.
+
+    Commits with the same tree as the previous one (amended messages,
+    rebases without content change) do not trigger any rollout. changed_files
+    lists the paths changed since the last processed commit. It can also be
+    a callable, given the last processed commit and tree, only called when
+    the commit is not skipped. When it is None, the changes are unknown and
+    every mapped deployment is rolled out.
+
+    When previous_commit is given, changed_files are relative to it and the
+    commit is only processed if previous_commit is the last processed one.
+    Returns False when it is not, True otherwise.
+    """
+    global _latest_commit, _latest_tree
+    with _rollout_lock:
+        if commit_sha == _latest_commit:
+            logging.debug("Commit %s already processed, skipping.", commit_sha)
+            return True
+        if previous_commit is not None and previous_commit != _latest_commit:
+            logging.info("Push %s does not follow the last processed commit %s, skipping.",
+                         commit_sha, _latest_commit)
+            return False
+        if tree_sha is not None and tree_sha == _latest_tree:
+            logging.info("Commit %s does not change the repository content, skipping.", commit_sha)
+        else:
+            if callable(changed_files):
+                changed_files = changed_files(_latest_commit, _latest_tree)
+            deployment_map = current_deployment_map()
+            if changed_files is None:
+                logging.warning("Changes since the last processed commit are unknown, rolling out all deployments.")
+                affected_deployments = deployment_map.all_deployments()
+            else:
+                affected_deployments = affected_deployments_for_commit(
+                    (_latest_commit, commit_sha), changed_files, deployment_map)
+            if affected_deployments:
+                logging.info("Deployments to rollout: %s", sorted(affected_deployments))
+                trigger_rollout(affected_deployments, ROLLOUT_NAMESPACE)
+        _latest_commit = commit_sha
+        _latest_tree = tree_sha
+        return True
+
+def check_for_new_commit(repo_url, repo_local_path):
+    """Poll the remote branch and process its head commit if it changed."""
+    new_commit = get_latest_commit(repo_url, GIT_BRANCH, GIT_SSH_COMMAND)
+    if new_commit == _latest_commit:
+        return
+    logging.info("New commit detected: %s", new_commit)
+    fetch_commit(repo_local_path, new_commit, GIT_SSH_COMMAND)
+    tree_sha = get_commit_tree(repo_local_path, new_commit)
+    # Diffed by on_push under its lock against the last processed tree, only if it changed
+    on_push(new_commit, lambda previous_commit, previous_tree: get_changes_since(
+        repo_local_path, previous_commit, previous_tree, tree_sha, GIT_SSH_COMMAND), tree_sha)
+
+def verify_signature(secret, body, headers):
+    """Authenticate a webhook call with the shared secret.
+
+    GitHub and Gitea sign the body in X-Hub-Signature-256, GitLab sends the
+    secret itself in X-Gitlab-Token.
+    """
+    gitlab_token = headers.get('X-Gitlab-Token')
+    if gitlab_token is not None:
+        return hmac.compare_digest(gitlab_token.encode(), secret.encode())
+
+    signature = headers.get('X-Hub-Signature-256')
+    if not signature:
+        return False
+    expected = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected.encode(), signature.encode())
+
+def parse_push_event(payload, branch):
+    """Extract the new and previous heads, the tree and the changed files from a push event payload.
+
+    Returns None when the event does not update the tracked branch. The tree
+    is None when the payload does not provide it (GitLab), the changed files
+    are None when the payload does not list all the commits since the
+    previous head.
+    """
+    if payload.get('ref') != f'refs/heads/{branch}':
+        return None
+    commit_sha = payload.get('after', '')
+    if not commit_sha.strip('0'):
+        # Branch deletion (or malformed payload), nothing to roll out
+        return None
+
+    previous_commit = payload.get('before')
+    tree_sha = (payload.get('head_commit') or {}).get('tree_id')
+    commits = payload.get('commits') or []
+    # GitLab reports total_commits_count and Gitea total_commits, both only
+    # list the first commits of large pushes
+    total_commits = payload.get('total_commits_count', payload.get('total_commits', len(commits)))
+    if (payload.get('forced') or not previous_commit or not commits
+            or not isinstance(total_commits, int) or total_commits > len(commits)):
+        # Force push, unknown previous head or truncated commit list
+        return commit_sha, previous_commit, tree_sha, None
+
+    changed_files = set()
+    for commit in commits:
+        for key in ('added', 'removed', 'modified'):
+            changed_files.update(commit.get(key) or [])
+    return commit_sha, previous_commit, tree_sha, list(changed_files)
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receive Git push notifications on /webhook."""
+
+    def do_POST(self):
+        if self.path != '/webhook':
+            self._respond(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self._respond(400)
+            return
+        if length < 0:
+            self._respond(400)
+            return
+        if length > WEBHOOK_MAX_BODY_SIZE:
+            # Refuse before reading, the payload is not authenticated yet
+            self._respond(413)
+            return
+
+        body = self.rfile.read(length)
+        if not verify_signature(WEBHOOK_SECRET, body, self.headers):
+            logging.warning("Rejected webhook call with an invalid signature.")
+            self._respond(401)
+            return
+
+        try:
+            push = parse_push_event(json.loads(body), GIT_BRANCH)
+        except (ValueError, AttributeError, TypeError):
+            self._respond(400)
+            return
+
+        # Acknowledge before rolling out so the VCS does not time out
+        self._respond(202)
+        invalidate_commit_cache()
+        if push is None:
+            return
+
+        commit_sha, previous_commit, tree_sha, changed_files = push
+        logging.info("Push received for commit %s", commit_sha)
+        if changed_files is None:
+            # Let the poll loop compute the changes from the local clone
+            _wakeup.set()
+            return
+        try:
+            # Out of order or redelivered events are stale: the poll loop
+            # resolves the actual head and diffs it from the local clone
+            if not on_push(commit_sha, changed_files, tree_sha, previous_commit):
+                _wakeup.set()
+        except Exception as e:
+            logging.error("%s", e)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Webhook %s - " + format, self.address_string(), *args)
+
+def start_webhook_server(port):
+    """Serve the push webhook from a background thread."""
+    server = ThreadingHTTPServer(('', port), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Webhook listener started on port %s", port)
+    return server
+
+def request_shutdown(signum, frame):
+    """Signal handler stopping the poll loop without waiting for the next poll.
+
+    Handlers run on the main thread between two bytecodes, possibly while it
+    holds the internal lock of _wakeup in wait() or clear(): the events are
+    set from another thread instead.
+    """
+    threading.Thread(target=stop_polling, args=(signum,)).start()
+
+def stop_polling(signum):
+    """Stop the poll loop and interrupt its current wait."""
+    logging.info("Received signal %s, shutting down.", signum)
+    _shutdown.set()
+    _wakeup.set()
 
 def main():
-    logging.info(f"Starting agent with configuration:")
-    logging.info(f"Repository URL: {GIT_REPO_URL}")
-    logging.info(f"Branch: {GIT_BRANCH}")
-    logging.info(f"Poll interval: {POLL_INTERVAL} seconds")
-    logging.info(f"Rollout namespace: {ROLLOUT_NAMESPACE}")
+    global _latest_commit, _latest_tree, GIT_SSH_COMMAND
+    logging.info(
+        "Starting agent: repository=%s branch=%s poll_interval=%ds namespace=%s",
+        GIT_REPO_URL, GIT_BRANCH, POLL_INTERVAL, ROLLOUT_NAMESPACE
+    )
 
     if GIT_SSH_COMMAND:
         logging.info("SSH command is set, using SSH keys for authentication.")
-        logging.info(f"Git SSH Command: {GIT_SSH_COMMAND}")
-        #show_ssh_key(GIT_SSH_COMMAND)
+        logging.info("Git SSH Command: %s", GIT_SSH_COMMAND)
+        show_ssh_key(GIT_SSH_COMMAND)
+        GIT_SSH_COMMAND = enable_ssh_multiplexing(GIT_SSH_COMMAND)
+        # Also used by the git commands spawned by GitPython
+        os.environ['GIT_SSH_COMMAND'] = GIT_SSH_COMMAND
     else:
         logging.info("SSH command is not set, not using SSH keys.")
 
@@ -173,24 +697,32 @@ def main():
 
     clone_repo(repo_url, GIT_BRANCH, repo_local_path)
 
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+
     try:
-        deployment_map = load_deployment_map(ROLLOUT_MAPPING_FILE)
-        latest_commit = get_latest_commit(repo_url, GIT_BRANCH, GIT_SSH_COMMAND)
-        logging.info(f"Initial commit: {latest_commit}")
-
-        while True:
-            time.sleep(POLL_INTERVAL)
-            new_commit = get_latest_commit(repo_url, GIT_BRANCH, GIT_SSH_COMMAND)
-            if new_commit != latest_commit:
-                logging.info(f"New commit detected: {new_commit}")
-                changed_files = get_changed_files(repo_local_path, GIT_BRANCH, new_commit, GIT_SSH_COMMAND)
-                affected_deployments = determine_affected_deployments(changed_files, deployment_map)
-                if affected_deployments:
-                    logging.info(f"Deployments to rollout: {affected_deployments}")
-                    trigger_rollout(','.join(affected_deployments), ROLLOUT_NAMESPACE)
-                latest_commit = new_commit
+        # Fail early on an invalid mapping file, it is reloaded when it changes
+        current_deployment_map()
+        _latest_commit = get_latest_commit(repo_url, GIT_BRANCH, GIT_SSH_COMMAND)
+        _latest_tree = get_commit_tree(repo_local_path, _latest_commit)
+        logging.info("Initial commit: %s", _latest_commit)
+
+        poll_interval = POLL_INTERVAL
+        if WEBHOOK_SECRET:
+            start_webhook_server(WEBHOOK_PORT)
+            # Pushes are notified, polling is only a safety net for missed deliveries
+            poll_interval = WEBHOOK_FALLBACK_INTERVAL
+            logging.info("Fallback poll interval: %s seconds", poll_interval)
+
+        while not _shutdown.is_set():
+            _wakeup.wait(poll_interval)
+            _wakeup.clear()
+            if _shutdown.is_set():
+                break
+            check_for_new_commit(repo_url, repo_local_path)
+        logging.info("Agent stopped.")
     except Exception as e:
-        logging.error(str(e))
+        logging.error("%s", e)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file